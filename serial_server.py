@@ -22,9 +22,12 @@ import sys
 import inspect
 import configparser
 from serial import Serial, PARITY_NAMES
-from socket import socket, create_server, SHUT_RDWR
+from socket import create_server, SHUT_RDWR
+from collections import deque
+from itertools import islice
+from functools import lru_cache
 from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
-from time import time, sleep
+from time import time, monotonic, sleep
 from contextlib import suppress
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 from errno import EBUSY
@@ -38,34 +41,48 @@ def parse_bytes(s):
     return s.encode() if isinstance(s, str) else bytes(s)
 
 # method for getting the initial argument names of a class
+@lru_cache(maxsize=None)
 def get_init_argnames(cls):
     specs = inspect.getfullargspec(cls.__init__)
     return specs.args[1:] + specs.kwonlyargs
 
 # parse parity string into serial.PARITY_* constants
+# accepts both the constants and their names, in any case
+PARITY_LOOKUP = {parity.casefold(): parity for parity in PARITY_NAMES} | {
+    name.casefold(): parity for parity, name in PARITY_NAMES.items()}
+
 def parse_parity(par):
-    par = par.casefold()
-    for parity, parity_name in PARITY_NAMES.items():
-        if par == parity.casefold() or par == parity_name.casefold():
-            return parity
+    return PARITY_LOOKUP.get(par.casefold())
 
 # parse a string to bool
+TRUE_KEYS = frozenset(('true', 't', 'yes', 'y', '1'))
+
 def parse_bool(boo):
-    boo = boo.lower()
-    true_keys = ('true', 't', 'yes', 'y', '1')
-    return (boo in true_keys)
+    return (boo.lower() in TRUE_KEYS)
 
 # default string parsing that interprets escape sequences
+# non-Latin-1 characters pass through as escapes that decode back to them
 def parse_str(s):
-    return eval(f'"{s}"')
+    return s.encode('latin-1', 'backslashreplace').decode('unicode_escape')
 
 ### CLASS DEFINITION ###
 
 class SerialServer:
 
+    # limits of pending bytes per client (queued queries and unsent replies)
+    # reading from a client pauses above the high mark to bound memory use,
+    # and resumes when the pending data drops below the low mark;
+    # a client whose unterminated query exceeds the high mark is disconnected
+    pending_high = 48 * 1024
+    pending_low = 16 * 1024
+    # maximum number of queries sent in one write when pipelining; the device
+    # and the serial drivers need to buffer the queries and their replies
+    pipeline_depth = 16
+
     def __init__(self,
             name='', host='', listen_port=None, ser_kwargs=dict(), *,
-            eol_ser=b'\n', eol_sock=b'\n', selector_timeout=0.2):
+            eol_ser=b'\n', eol_sock=b'\n', selector_timeout=0.2,
+            flush_ser=True, pipeline=False):
         self._open = False # status indicator
         self._serving = False # status indicator
         self._shutdown_request = False # termination request indicator
@@ -75,17 +92,24 @@ class SerialServer:
         self.eol_sock = parse_bytes(eol_sock) # end of line - sockets
         self.eol_ser = parse_bytes(eol_ser) # end of line - serial
         self.selector_timeout = selector_timeout # shutdown check period
+        self.flush_ser = flush_ser # wait for each query to be transmitted
+        self.pipeline = pipeline # send queries without waiting for replies
 
         self.serial = None
         self.ser_kwargs = {'timeout': 1., 'exclusive': True} | ser_kwargs
         self.timeout = self.ser_kwargs['timeout']
         self.sock = None # listening socket
         self.sel = None # read/write selector
-        self.ser_queue = [] # queue for the serial port
+        self.ser_queue = deque() # queue for the serial port
+        self.ser_waiting = deque() # ClientBuffers waiting for serial replies
+        self.ser_reply = bytearray() # serial reply received so far
+        self.ser_deadline = 0. # monotonic time limit for the serial reply
         self.clients = set() # connected client sockets
+        self.client_pool = deque(maxlen=64) # ClientBuffers kept for reuse
+        self.recv_buf = memoryview(bytearray(4096)) # reusable receive buffer
 
 
-    # serial port timeout - important because the port is used in blocking mode
+    # serial port timeout - limits writing and waiting for a reply
     @property
     def timeout(self):
         return self._timeout
@@ -111,6 +135,20 @@ class SerialServer:
                 self.serial.close()
             self.serial = None
             self.ser_queue.clear()
+            self.ser_waiting.clear()
+            self.ser_reply.clear()
+            # immutable copies of the delimiters for the event handlers
+            self._eol_sock = bytes(self.eol_sock)
+            self._eol_sock_len = len(self._eol_sock)
+            self._eol_ser = bytes(self.eol_ser)
+            self._eol_ser_len = len(self._eol_ser)
+            # serial replies only need translating if the delimiters differ;
+            # single-byte delimiters are swapped faster by a translation table
+            self._eol_translate = (self._eol_ser != self._eol_sock)
+            self._eol_table = None
+            if (self._eol_translate
+                    and self._eol_ser_len == self._eol_sock_len == 1):
+                self._eol_table = bytes.maketrans(self._eol_ser, self._eol_sock)
             exc = Exception()
             time_i = time()
             # Try to open the serial port with some grace period
@@ -129,7 +167,13 @@ class SerialServer:
                 raise exc
             self.sock = create_server(self.addr)
             self.sock.setblocking(False)
-            self.sel.register(self.sock, EVENT_READ, None)
+            # selector data is a tuple of the event handler and its payload
+            self.sel.register(self.sock, EVENT_READ,
+                              data=(self.process_listener, None))
+            # selectors do not accept an empty event mask, so the serial port
+            # stays registered for reading and writing is toggled by modify()
+            self.sel.register(self.serial, EVENT_READ,
+                              data=(self.process_serial, self.ser_queue))
             self._open = True
         return self
 
@@ -139,20 +183,27 @@ class SerialServer:
             raise RuntimeError("Cannot perform a close on a running server;"
                                "call stop() first")
         if self._open:
-            # don't raise exceptions if something is already closed
+            # don't raise exceptions if something is already closed;
+            # each resource separately, so one failure does not leak the rest
+            with suppress(OSError):
+                self.sel.unregister(self.serial)
             with suppress(OSError):
                 self.sel.close()
-                self.sel = None
+            self.sel = None
+            with suppress(OSError):
                 self.serial.close()
-                self.serial = None
-                self.ser_queue.clear()
+            self.serial = None
+            self.ser_queue.clear()
+            with suppress(OSError):
                 self.sock.shutdown(SHUT_RDWR)
+            with suppress(OSError):
                 self.sock.close()
-                self.sock = None
-                # should not have any clients listed; just in case
-                for client in self.clients:
+            self.sock = None
+            # should not have any clients listed; just in case
+            for client in self.clients:
+                with suppress(OSError):
                     client.close()
-                self.clients.clear()
+            self.clients.clear()
             self._open = False
 
     def __enter__(self):
@@ -167,89 +218,257 @@ class SerialServer:
             self._shutdown_request = True
 
     # input/output queues for a client socket
-    # is passed as a data structure to the selector
+    # is passed to the selector as the payload of the client handler
     class ClientBuffers():
+        # fixed attributes for faster access and a smaller footprint
+        __slots__ = ('sock', 'in_buf', 'out_buf', 'out_off', 'scan_pos',
+                     'pending', 'paused', 'queued')
+
         def __init__(self, sock):
-            self.sock = sock
             self.in_buf = bytearray()
-            self.out_buf = bytearray()
+            self.out_buf = deque() # replies waiting to be sent
+            self.reset(sock)
 
-    # process socket I/O; accepts a selector key and an event mask
-    def process_socket(self, key, mask):
+        # empty the buffers and assign a socket, so the object can be reused
+        def reset(self, sock):
+            self.sock = sock
+            self.in_buf.clear()
+            self.out_buf.clear()
+            self.out_off = 0 # number of bytes already sent from out_buf[0]
+            self.scan_pos = 0 # in_buf position to resume the EOL search at
+            self.pending = 0 # bytes of queued queries and unsent replies
+            self.paused = False # reading paused because of too much pending
+            self.queued = 0 # number of queries waiting for a serial reply
+
+    # change the events of a registered file object, keeping its data
+    # the key remembers the current events, so redundant changes are skipped
+    def set_events(self, fileobj, events):
+        key = self.sel.get_key(fileobj)
+        if key.events != events:
+            self.sel.modify(fileobj, events, data=key.data)
+
+    # register a client socket for the events it currently needs;
+    # a client that is neither read from nor written to is unregistered
+    def update_client(self, clientbuf):
+        sock = clientbuf.sock
+        events = 0 if clientbuf.paused else EVENT_READ
+        if clientbuf.out_buf:
+            events |= EVENT_WRITE
+        key = self.sel.get_map().get(sock)
+        if key is None:
+            if events:
+                self.sel.register(sock, events,
+                                  data=(self.process_client, clientbuf))
+        elif not events:
+            self.sel.unregister(sock)
+        elif key.events != events:
+            self.sel.modify(sock, events, data=key.data)
+
+    # pause or resume reading from a client depending on its pending data
+    def throttle_client(self, clientbuf):
+        if clientbuf.paused:
+            if clientbuf.pending < self.pending_low:
+                clientbuf.paused = False
+                self.update_client(clientbuf)
+        elif clientbuf.pending > self.pending_high:
+            clientbuf.paused = True
+            self.update_client(clientbuf)
+
+    # disconnect a client socket
+    def drop_client(self, clientbuf):
+        sock = clientbuf.sock
+        if sock in self.sel.get_map():
+            self.sel.unregister(sock)
+        self.clients.discard(sock)
+        with suppress(OSError):
+            sock.shutdown(SHUT_RDWR)
+        sock.close()
+        self.recycle_client(clientbuf)
+
+    # keep the ClientBuffers of a disconnected client for reuse,
+    # unless the serial queue still refers to it
+    def recycle_client(self, clientbuf):
+        if not clientbuf.queued:
+            clientbuf.reset(None)
+            self.client_pool.append(clientbuf)
+
+    # accept clients; accepts a selector key and an event mask
+    def process_listener(self, key, mask):
+        if mask & EVENT_READ:
+            s, _ = key.fileobj.accept() # get client socket
+            self.clients.add(s)
+            if self.client_pool: # reuse the buffers of a previous client
+                clientbuf = self.client_pool.pop()
+                clientbuf.sock = s
+            else:
+                clientbuf = self.ClientBuffers(s)
+            self.sel.register(s, EVENT_READ,
+                              data=(self.process_client, clientbuf))
+
+    # process client socket I/O; accepts a selector key and an event mask
+    def process_client(self, key, mask):
         sock = key.fileobj
-        data = key.data # ClientBuffers object
-        if data is None: # listening socket
-            if mask & EVENT_READ:
-                s, _ = sock.accept() # get client socket
-                self.clients.add(s)
-                self.sel.register(s, EVENT_READ, data=self.ClientBuffers(s))
-        elif mask & EVENT_READ: # client socket reading
-            received = sock.recv(1024)
-            if received:
-                data.in_buf += received # append to previously received data
-                chunks = data.in_buf.split(self.eol_sock) # split into queries
-                data.in_buf = chunks.pop() # put any trailing data back
-                if chunks: # if there are any whole queries left
-                    # if the serial queue is empty, register the serial device
-                    # for writing so the queue can be processed.
-                    if not self.ser_queue:
-                        self.sel.register(self.serial, EVENT_WRITE,
-                                          data=self.ser_queue)
-                    for cmd in chunks:
-                        # submit a query and the corresponding ClientBuffers
-                        self.ser_queue.append((cmd, data))
+        data = key.data[1] # ClientBuffers object
+        if mask & EVENT_READ: # client socket reading
+            # receive into the preallocated buffer to avoid a new bytes object
+            try:
+                nbytes = sock.recv_into(self.recv_buf)
+            except ConnectionError:
+                nbytes = 0
+            if nbytes:
+                data.in_buf += self.recv_buf[:nbytes] # append to previous data
+                in_buf = data.in_buf
+                eol = self._eol_sock
+                eol_len = self._eol_sock_len
+                start = 0 # beginning of the current query
+                end = in_buf.find(eol, data.scan_pos)
+                while end != -1: # extract whole queries
+                    # if the serial queue is empty and idle, enable writing to
+                    # the serial device so the queue can be processed.
+                    if not self.ser_queue and not self.ser_waiting:
+                        self.set_events(self.serial, EVENT_READ | EVENT_WRITE)
+                    # submit a query and the corresponding ClientBuffers
+                    self.ser_queue.append((bytes(in_buf[start:end]), data))
+                    data.pending += end - start
+                    data.queued += 1
+                    start = end + eol_len
+                    end = in_buf.find(eol, start)
+                del in_buf[:start] # keep any trailing data
+                if len(in_buf) > self.pending_high: # no end of query in sight
+                    in_buf.clear()
+                    self.drop_client(data)
+                    return
+                # next time, only rescan where a split delimiter could start
+                data.scan_pos = max(0, len(in_buf) - eol_len + 1)
+                self.throttle_client(data)
             else: # if empty bytes read, the socket is dead
-                self.sel.unregister(sock)
-                self.clients.remove(sock)
-                sock.shutdown(SHUT_RDWR)
-                sock.close()
+                self.drop_client(data)
         elif mask & EVENT_WRITE: # client socket writing
-            sent = sock.send(data.out_buf)
-            data.out_buf = data.out_buf[sent:] # keep data that was not sent
-            if not data.out_buf:
-                # everything sent; register for reading only
-                self.sel.modify(sock, EVENT_READ, data=data)
+            # send pending replies in one call; the number of buffers per call
+            # is limited by the system (IOV_MAX is at least 16 by POSIX)
+            out_buf = data.out_buf
+            buffers = [memoryview(out_buf[0])[data.out_off:]]
+            buffers.extend(islice(out_buf, 1, 16))
+            try:
+                sent = sock.sendmsg(buffers)
+            except ConnectionError:
+                self.drop_client(data)
+                return
+            data.pending -= sent
+            sent += data.out_off
+            # drop the replies that were sent completely
+            while out_buf and sent >= len(out_buf[0]):
+                sent -= len(out_buf.popleft())
+            data.out_off = sent # keep data that was not sent
+            if not out_buf:
+                # everything sent; stop writing
+                self.update_client(data)
+            self.throttle_client(data)
 
     # process serial I/O; accepts a selector key and an event mask
     def process_serial(self, key, mask):
         ser = key.fileobj
-        data = key.data # self.ser_queue
+        data = key.data[1] # self.ser_queue
+        if mask & EVENT_READ:
+            received = ser.read(ser.in_waiting or 1) # only what is available
+            # discard unsolicited data; no query is waiting for it
+            if self.ser_waiting:
+                reply = self.ser_reply
+                eol = self._eol_ser
+                eol_len = self._eol_ser_len
+                start = max(0, len(reply) - eol_len + 1)
+                reply += received
+                end = reply.find(eol, start)
+                while end != -1: # pass on every complete reply
+                    self.finish_reply(end + eol_len)
+                    end = reply.find(eol) if self.ser_waiting else -1
         if mask & EVENT_WRITE:
-            cmd, clientbuf = data.pop(0) # get the query submitted first
-            if not data: # if no queries remain, unregister for writing
-                self.sel.unregister(ser)
-            query = cmd + self.eol_ser
-            while query: # write the whole query
-                written = ser.write(query)
-                query = query[written:]
-            ser.flush()
-            reply = ser.read_until(self.eol_ser) # blocking read
-            reply = reply.replace(self.eol_ser, self.eol_sock)
-            # if the socket output buffer is empty, register for writing
-            if (not clientbuf.out_buf) and (clientbuf.sock in self.clients):
-                self.sel.modify(clientbuf.sock, EVENT_READ | EVENT_WRITE,
-                                data=clientbuf)
-            clientbuf.out_buf.extend(reply)
+            cmd, clientbuf = data.popleft() # get the query submitted first
+            clientbuf.pending -= len(cmd)
+            self.ser_waiting.append(clientbuf)
+            query = [cmd, self._eol_ser]
+            # when pipelining, also send the queries that follow from the same
+            # client in one write, without waiting for the replies in between
+            if self.pipeline:
+                while (data and data[0][1] is clientbuf
+                       and len(query) < 2 * self.pipeline_depth):
+                    cmd = data.popleft()[0]
+                    clientbuf.pending -= len(cmd)
+                    self.ser_waiting.append(clientbuf)
+                    query += (cmd, self._eol_ser)
+            # stop writing until the replies arrive
+            self.sel.modify(ser, EVENT_READ, data=key.data)
+            query = memoryview(b''.join(query))
+            offset = 0
+            while offset < len(query): # write the whole query without copying
+                offset += ser.write(query[offset:])
+            if self.flush_ser: # blocks until the output is transmitted
+                ser.flush()
+            # the reply is collected as it arrives, without blocking
+            self.ser_deadline = monotonic() + self.timeout
+
+    # pass the first size bytes of the received data as a reply to the first
+    # waiting client; on timeout, everything received so far is passed along
+    # when no more replies are expected, resume the serial queue
+    def finish_reply(self, size=None):
+        clientbuf = self.ser_waiting.popleft()
+        reply = bytes(self.ser_reply[:size])
+        if self._eol_table is not None:
+            reply = reply.translate(self._eol_table)
+        elif self._eol_translate:
+            reply = reply.replace(self._eol_ser, self._eol_sock)
+        if self.ser_waiting: # pipelined replies; the next one gets full time
+            del self.ser_reply[:size]
+            self.ser_deadline = monotonic() + self.timeout
+        else: # drop anything that follows the reply
+            self.ser_reply.clear()
+        clientbuf.queued -= 1
+        if clientbuf.sock not in self.clients: # client already disconnected
+            self.recycle_client(clientbuf)
+        else:
+            clientbuf.out_buf.append(reply)
+            clientbuf.pending += len(reply)
+            # if the socket output buffer was empty, register for writing
+            if len(clientbuf.out_buf) == 1:
+                self.update_client(clientbuf)
+            self.throttle_client(clientbuf)
+        if self.ser_queue and not self.ser_waiting: # enable writing
+            self.set_events(self.serial, EVENT_READ | EVENT_WRITE)
+
+    # wait for I/O events at most for the given time and handle them
+    # this is one iteration of serve_forever(); it can also be driven by
+    # another event loop, e.g. asyncio's loop.add_reader(server.sel.fileno(),
+    # server.handle_events) where the selector provides a file descriptor,
+    # plus a periodic call so that serial reply timeouts are noticed
+    def handle_events(self, timeout=0.):
+        if self.ser_waiting: # wake up for reply timeout
+            remaining = max(0., self.ser_deadline - monotonic())
+            # no timeout means waiting without limit, i.e. until the deadline
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        for key, mask in self.sel.select(timeout):
+            if self._shutdown_request:
+                break
+            key.data[0](key, mask) # call the handler of the key
+        # serial reply timed out; pass on what was received
+        if self.ser_waiting and monotonic() >= self.ser_deadline:
+            self.finish_reply()
 
     # main serving loop
     def serve_forever(self):
         if not self._open:
             self.open()
         self._serving = True
+        # local names for what the loop uses on every iteration
+        handle_events = self.handle_events
+        selector_timeout = self.selector_timeout
         try:
             while not self._shutdown_request:
-                events = self.sel.select(self.selector_timeout)
-                for key, mask in events:
-                    if self._shutdown_request:
-                        break
-                    elif isinstance(key.fileobj, socket):
-                        self.process_socket(key, mask)
-                    elif isinstance(key.fileobj, Serial):
-                        self.process_serial(key, mask)
+                handle_events(selector_timeout)
         finally: # clean up at the end
-            with suppress(OSError):
-                for client in self.clients:
+            for client in self.clients:
+                with suppress(OSError):
                     client.shutdown(SHUT_RDWR)
+                with suppress(OSError):
                     client.close()
             self.clients.clear()
             self._serving = False
@@ -269,6 +488,8 @@ class SerialServer:
     parselib = {
         'listen_port': int,
         'selector_timeout': int,
+        'flush_ser': parse_bool,
+        'pipeline': parse_bool,
         'baudrate': int,
         'bytesize': int,
         'parity': parse_parity,
@@ -282,6 +503,18 @@ class SerialServer:
         'exclusive': parse_bool,
     }
 
+    # map config parameters to whether they go to the serial port,
+    # and to their parsing function; class arguments take precedence
+    @classmethod
+    @lru_cache(maxsize=None)
+    def config_dispatch(cls):
+        dispatch = dict()
+        for par in get_init_argnames(Serial):
+            dispatch[par] = (True, cls.parselib.get(par, parse_str))
+        for par in get_init_argnames(cls):
+            dispatch[par] = (False, cls.parselib.get(par, parse_str))
+        return dispatch
+
     # load configuration according to server name
     # if there is no name, load [DEFAULT] section from the config file
     def loadconfig(self, file='serial_server.conf'):
@@ -292,19 +525,16 @@ class SerialServer:
         section = self.name if self.name else configparser.DEFAULTSECT
         cfgpars = cfg[section]
 
-        initvars = get_init_argnames(self)
-        serialvars = get_init_argnames(Serial)
+        dispatch = self.config_dispatch()
 
         # collect all config parameters and distribute them into class arguments
         # and serial arguments
         ser_kwargs = dict()
         args = {'name': section, 'ser_kwargs': ser_kwargs}
         for par, val in cfgpars.items():
-            parse = self.parselib.get(par, parse_str)
-            if par in initvars:
-                args[par] = parse(val)
-            elif par in serialvars:
-                ser_kwargs[par] = parse(val)
+            if par in dispatch:
+                serial_par, parse = dispatch[par]
+                (ser_kwargs if serial_par else args)[par] = parse(val)
 
         self.__init__(**args)
 